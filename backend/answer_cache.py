@@ -0,0 +1,147 @@
+# In-memory cache of validated chat answers, shared by everyone asking about the same document text
+
+import difflib
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+# answers kept in memory
+answer_cache_entries = int(os.getenv("ANSWER_CACHE_ENTRIES", "2048"))
+# seconds an answer is served before it has to be generated again
+answer_cache_ttl = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# messages before the question that must match for an answer to be reused
+answer_cache_history = int(os.getenv("ANSWER_CACHE_HISTORY", "2"))
+# normalized questions at least this similar (difflib ratio, e.g. 0.92) share an answer; 0 only reuses exact matches
+answer_cache_similarity = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+
+_punctuation = re.compile(r"[^\w\s]", re.UNICODE)
+_number = re.compile(r"\d+")
+
+
+def normalize_question(question: str) -> str:
+    """Lowercase, without punctuation and with single spaces: "What's the due date?" -> "what s the due date"."""
+    return " ".join(_punctuation.sub(" ", question.lower()).split())
+
+
+def history_fingerprint(history: List[Dict], turns: int = answer_cache_history) -> str:
+    """Hash of the last `turns` messages before the question; a first question always hashes the same."""
+    recent = [(m.get("role"), m.get("content")) for m in history[-turns:]] if turns > 0 else []
+    return hashlib.sha256(json.dumps(recent).encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    """
+    Answers that passed Gemini validation, keyed on the document text's
+    hash, the recent history's fingerprint, the answer language and the
+    normalized question.
+
+    Entries are evicted least-recently-used past max_entries and expire
+    ttl seconds after they were stored. A question with no exact entry can
+    reuse the answer of a near-identical one (difflib ratio >= similarity)
+    asked under the same document, history and language, as long as both
+    mention the same numbers ("item 1" is never "item 2").
+    """
+
+    def __init__(self, max_entries: int, ttl: float, similarity: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # (scope, question) -> (answer, stored_at), oldest first
+        self._entries: "OrderedDict[Tuple[Tuple[str, str, str], str], Tuple[str, float]]" = OrderedDict()
+        # scope -> normalized questions stored under it, for near-duplicate lookups
+        self._questions: Dict[Tuple[str, str, str], set] = {}
+
+    @staticmethod
+    def scope_for(document_digest: str, history: List[Dict], language: Optional[str]) -> Tuple[str, str, str]:
+        return document_digest, history_fingerprint(history), (language or "").strip().lower()
+
+    def get(self, scope: Tuple[str, str, str], question: str) -> Optional[str]:
+        question = normalize_question(question)
+        now = time.monotonic()
+        with self._lock:
+            answer = self._lookup((scope, question), now)
+            if answer is not None:
+                self.hits += 1
+                return answer
+            if self.similarity > 0:
+                for candidate in self._near(scope, question):
+                    answer = self._lookup((scope, candidate), now)
+                    if answer is not None:
+                        self.near_hits += 1
+                        return answer
+            self.misses += 1
+            return None
+
+    def put(self, scope: Tuple[str, str, str], question: str, answer: str):
+        """Store an answer; only call this for answers that passed validation."""
+        key = (scope, normalize_question(question))
+        with self._lock:
+            self._entries[key] = (answer, time.monotonic())
+            self._entries.move_to_end(key)
+            self._questions.setdefault(scope, set()).add(key[1])
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._forget(old_key)
+                self.evictions += 1
+
+    def _lookup(self, key, now: float) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        answer, stored_at = entry
+        if now - stored_at > self.ttl:
+            del self._entries[key]
+            self._forget(key)
+            return None
+        self._entries.move_to_end(key)
+        return answer
+
+    def _near(self, scope, question: str) -> List[str]:
+        # best match first; quick_ratio is a cheap upper bound that skips most candidates
+        matcher = difflib.SequenceMatcher(b=question, autojunk=False)
+        numbers = _number.findall(question)
+        scored = []
+        for candidate in self._questions.get(scope, ()):
+            if _number.findall(candidate) != numbers:
+                continue
+            matcher.set_seq1(candidate)
+            if matcher.real_quick_ratio() >= self.similarity and matcher.quick_ratio() >= self.similarity:
+                ratio = matcher.ratio()
+                if ratio >= self.similarity:
+                    scored.append((ratio, candidate))
+        return [candidate for _, candidate in sorted(scored, reverse=True)]
+
+    def _forget(self, key):
+        scope, question = key
+        questions = self._questions.get(scope)
+        if questions is not None:
+            questions.discard(question)
+            if not questions:
+                del self._questions[scope]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.near_hits + self.misses
+            return {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.near_hits) / lookups if lookups else 0.0,
+                "near_hit_rate": self.near_hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+            }
+
+
+answer_cache = AnswerCache(answer_cache_entries, answer_cache_ttl, answer_cache_similarity)
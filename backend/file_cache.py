@@ -0,0 +1,48 @@
+# In-memory LRU of objects loaded from files on disk, checked against the file's mtime
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class FileCache(Generic[T]):
+    """
+    LRU of loaded objects keyed by file path; an object whose file changed on disk is reloaded.
+
+    load reads an object from a path; objects written through save must have
+    a save(path) method (RegionStore, ChunkIndex).
+    """
+
+    def __init__(self, load: Callable[[str], T], max_entries: int):
+        self.load = load
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[int, T]]" = OrderedDict()
+
+    def get(self, path: str) -> Optional[T]:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(path)
+                return entry[1]
+        value = self.load(path)
+        self._remember(path, mtime, value)
+        return value
+
+    def save(self, path: str, value: T):
+        value.save(path)
+        self._remember(path, os.stat(path).st_mtime_ns, value)
+
+    def _remember(self, path: str, mtime: int, value: T):
+        with self._lock:
+            self._entries[path] = (mtime, value)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
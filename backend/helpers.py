@@ -1,31 +1,90 @@
+import asyncio
+import logging
 import os
+import random
+import httpx
+import openai
 from fastapi import UploadFile
-from openai import OpenAI
+from openai import AsyncOpenAI
 from google import genai
 from google.genai import types
-from google.genai.errors import ClientError
+from google.genai.errors import ClientError, ServerError
 
 
+# seconds one GPT/Gemini call may take (for a stream: to open it, and between two chunks)
+llm_call_timeout = float(os.getenv("LLM_CALL_TIMEOUT", "60"))
+# extra attempts after a timeout, rate limit, connection error or 5xx
+llm_retries = int(os.getenv("LLM_RETRIES", "2"))
+# first retry waits up to this long, doubling after that (full jitter)
+llm_retry_base_delay = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+# calls in flight per provider across all requests
+gpt_max_concurrency = int(os.getenv("GPT_MAX_CONCURRENCY", "16"))
+gemini_max_concurrency = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+# pooled connections shared by both providers' async clients
+llm_max_connections = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+
+logger = logging.getLogger(__name__)
+
 # Initialize clients lazily or with error handling
-GPT_client = None
-Gemini_client = None
+Async_GPT_client = None
+Async_Gemini_client = None
+LLM_http_client = None
+gpt_slots = asyncio.Semaphore(gpt_max_concurrency)
+gemini_slots = asyncio.Semaphore(gemini_max_concurrency)
+
+def get_llm_http_client() -> httpx.AsyncClient:
+    """One connection pool for every async LLM call."""
+    global LLM_http_client
+    if LLM_http_client is None:
+        LLM_http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=llm_max_connections, max_keepalive_connections=llm_max_connections),
+            timeout=httpx.Timeout(llm_call_timeout),
+        )
+    return LLM_http_client
 
-def get_gpt_client():
-    """Get or initialize GPT client."""
-    global GPT_client
-    if GPT_client is None:
+def get_async_gpt_client() -> AsyncOpenAI:
+    global Async_GPT_client
+    if Async_GPT_client is None:
         api_key = os.getenv("GPT_API_KEY")
         if not api_key:
             raise ValueError("GPT_API_KEY environment variable is not set")
-        GPT_client = OpenAI(api_key=api_key)
-    return GPT_client
+        # retries are ours (call_with_retries), so the SDK's own are off
+        Async_GPT_client = AsyncOpenAI(api_key=api_key, http_client=get_llm_http_client(), max_retries=0)
+    return Async_GPT_client
+
+def get_async_gemini_client():
+    global Async_Gemini_client
+    if Async_Gemini_client is None:
+        Async_Gemini_client = genai.Client(
+            http_options=types.HttpOptions(httpx_async_client=get_llm_http_client())
+        ).aio
+    return Async_Gemini_client
+
+async def close_llm_clients():
+    global Async_GPT_client, Async_Gemini_client, LLM_http_client
+    if LLM_http_client is not None:
+        await LLM_http_client.aclose()
+    Async_GPT_client = Async_Gemini_client = LLM_http_client = None
+
+def _retryable(exc: Exception) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, httpx.TransportError, openai.APIConnectionError,
+                        openai.RateLimitError, openai.InternalServerError, ServerError)):
+        return True
+    return isinstance(exc, ClientError) and exc.code == 429
 
-def get_gemini_client():
-    """Get or initialize Gemini client."""
-    global Gemini_client
-    if Gemini_client is None:
-        Gemini_client = genai.Client()
-    return Gemini_client
+async def call_with_retries(call, slots: asyncio.Semaphore):
+    """
+    Await call() under slots with a llm_call_timeout deadline, retrying transient failures up to
+    llm_retries times with exponential backoff and full jitter.
+    """
+    for attempt in range(llm_retries + 1):
+        try:
+            async with slots:
+                return await asyncio.wait_for(call(), llm_call_timeout)
+        except Exception as exc:
+            if attempt == llm_retries or not _retryable(exc):
+                raise
+            await asyncio.sleep(random.uniform(0, llm_retry_base_delay * 2 ** attempt))
 
 async def saveFile(file : UploadFile, user_id : int, document_id : int, type : str, base_path : str = "."):
     tmp_path = os.path.join(base_path, "tmp")
@@ -45,10 +104,7 @@ async def saveFile(file : UploadFile, user_id : int, document_id : int, type : s
 
     return file_path
 
-def get_gpt_response_with_context(messages: list, document_text: str, model: str = "gpt-4o-mini", language: str | None = None) -> str:
-    if not document_text or not document_text.strip():
-        return "I cannot find that information in the provided document."
-    
+def _gpt_messages(messages: list, document_text: str, language: str | None = None) -> list:
     language_instruction = ""
     if language:
         language_instruction = f"\n        - Respond ONLY in {language}. All your responses must be in {language}."
@@ -57,7 +113,7 @@ def get_gpt_response_with_context(messages: list, document_text: str, model: str
         "role": "system",
         "content": f"""You are a helpful assistant that answers questions based on the provided document.
 
-        DOCUMENT TEXT:
+        DOCUMENT TEXT (the parts relevant to the question; [...] marks text left out):
         {document_text}
 
         RULES:
@@ -66,17 +122,9 @@ def get_gpt_response_with_context(messages: list, document_text: str, model: str
         - Quote relevant parts of the document when answering{language_instruction}"""
     }
 
-    full_messages = [system_prompt] + messages
-
-    client = get_gpt_client()
-    response = client.chat.completions.create(
-        model=model,
-        messages=full_messages
-    )
-
-    return response.choices[0].message.content
+    return [system_prompt] + messages
 
-def check_logic_with_gemini(content: str, document_text: str, language: str | None = None) -> bool:
+def _validation_instruction(document_text: str, language: str | None = None) -> str:
     lang_note = ""
     if language:
         lang_note = f"\n    6.  **Language Note**: The answer may be in {language}, but the validation should focus on factual correctness regardless of language."
@@ -84,7 +132,7 @@ def check_logic_with_gemini(content: str, document_text: str, language: str | No
     system_instruction = f"""
     You are an **Expert Validation Engine** designed to check the factual basis of a given conclusion against a single, provided text document.
 
-    DOCUMENT CONTEXT:
+    DOCUMENT CONTEXT (the parts relevant to the question; [...] marks text left out):
     ---
     {document_text}
     ---
@@ -100,51 +148,91 @@ def check_logic_with_gemini(content: str, document_text: str, language: str | No
     [REASONABLE] -> **True**
     [UNREASONABLE] -> **False**
     """
+    return system_instruction
 
-    client = get_gemini_client()
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=content,
-        config=types.GenerateContentConfig(
-            system_instruction=system_instruction
-        )
-    )
+def _translation_prompt(text: str, target_language: str) -> str:
+    return f"""Translate the following text to {target_language}. 
+Only return the translated text, nothing else. Do not add any explanations or notes.
 
-    if response.text == "True":
-        return True
-    return False
+Text to translate:
+{text}"""
 
-def translate_text(text: str, target_language: str) -> str:
+async def get_gpt_response_with_context_async(messages: list, document_text: str, model: str = "gpt-4o-mini", language: str | None = None) -> str:
+    """GPT's answer to the conversation, grounded in document_text; pooled client, deadline and retries."""
+    if not document_text or not document_text.strip():
+        return "I cannot find that information in the provided document."
+
+    client = get_async_gpt_client()
+    response = await call_with_retries(
+        lambda: client.chat.completions.create(model=model, messages=_gpt_messages(messages, document_text, language)),
+        gpt_slots,
+    )
+    return response.choices[0].message.content
+
+async def stream_gpt_response_with_context_async(messages: list, document_text: str, model: str = "gpt-4o-mini", language: str | None = None):
     """
-    Translate text to target language using Gemini.
-    
-    Args:
-        text: Text to translate
-        target_language: Target language name (e.g., "Spanish", "French", "English")
-        
-    Returns:
-        Translated text, or original text if translation fails
+    Same answer as get_gpt_response_with_context_async, yielded piece by piece as GPT produces it.
+    Opening the stream is retried like any call; once text has been yielded a failure is raised
+    instead, and each chunk must arrive within llm_call_timeout.
     """
+    if not document_text or not document_text.strip():
+        yield "I cannot find that information in the provided document."
+        return
+
+    client = get_async_gpt_client()
+    async with gpt_slots:
+        for attempt in range(llm_retries + 1):
+            try:
+                stream = await asyncio.wait_for(
+                    client.chat.completions.create(model=model, messages=_gpt_messages(messages, document_text, language), stream=True),
+                    llm_call_timeout,
+                )
+                break
+            except Exception as exc:
+                if attempt == llm_retries or not _retryable(exc):
+                    raise
+                await asyncio.sleep(random.uniform(0, llm_retry_base_delay * 2 ** attempt))
+        try:
+            chunks = stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), llm_call_timeout)
+                except StopAsyncIteration:
+                    return
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # stops the HTTP response when the consumer gives up early
+            await stream.close()
+
+async def check_logic_with_gemini_async(content: str, document_text: str, language: str | None = None) -> bool:
+    """Whether Gemini finds content supported by document_text; pooled client, deadline and retries."""
+    client = get_async_gemini_client()
+    response = await call_with_retries(
+        lambda: client.models.generate_content(
+            model="gemini-2.5-flash",
+            contents=content,
+            config=types.GenerateContentConfig(system_instruction=_validation_instruction(document_text, language)),
+        ),
+        gemini_slots,
+    )
+    return response.text == "True"
+
+async def translate_text_async(text: str, target_language: str) -> str:
+    """Translate text to target_language with Gemini; returns the original text if translation fails."""
     if not text or not target_language:
         return text
-    
-    try:
-        prompt = f"""Translate the following text to {target_language}. 
-Only return the translated text, nothing else. Do not add any explanations or notes.
 
-Text to translate:
-{text}"""
-
-        client = get_gemini_client()
-        response = client.models.generate_content(
-            model="gemini-2.5-flash",
-            contents=prompt
+    try:
+        client = get_async_gemini_client()
+        response = await call_with_retries(
+            lambda: client.models.generate_content(model="gemini-2.5-flash", contents=_translation_prompt(text, target_language)),
+            gemini_slots,
         )
-        
         translated = response.text.strip()
         return translated if translated else text
-        
+
     except Exception as e:
         # If translation fails, return original text
-        print(f"Translation error: {e}")
+        logger.warning("Translation error: %s", e)
         return text
@@ -0,0 +1,96 @@
+# Accuracy helpers for the OCR pipeline: box matching against annotations or a reference run
+
+import json
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+import torch
+from torchvision.ops import box_iou
+
+Box = Sequence[float]
+
+
+def load_annotation(path: Path) -> List[Dict]:
+    """Ground-truth fields of one FUNSD-style annotation file as {'bbox', 'label', 'text'} dicts."""
+    with open(path, "r", encoding="utf-8") as f:
+        form = json.load(f).get("form", [])
+    return [
+        {"bbox": tuple(item["box"]), "label": item.get("label", "other"), "text": item.get("text", "")}
+        for item in form
+    ]
+
+
+def match_boxes(predicted: List[Box], reference: List[Box], iou_threshold: float = 0.5) -> List[Tuple[int, int]]:
+    """
+    Greedy one-to-one matching: predictions are taken in the order given
+    (callers pass them sorted by score) and each claims the unmatched
+    reference box it overlaps most, if that IoU reaches iou_threshold.
+    Returns (prediction index, reference index) pairs.
+    """
+    if not predicted or not reference:
+        return []
+    ious = box_iou(torch.tensor(predicted, dtype=torch.float32), torch.tensor(reference, dtype=torch.float32))
+    pairs = []
+    taken = torch.zeros(len(reference), dtype=torch.bool)
+    for pred_index in range(len(predicted)):
+        row = ious[pred_index].masked_fill(taken, -1.0)
+        ref_index = int(row.argmax())
+        if row[ref_index] >= iou_threshold:
+            taken[ref_index] = True
+            pairs.append((pred_index, ref_index))
+    return pairs
+
+
+def detection_scores(predicted: List[Dict], reference: List[Dict], iou_threshold: float = 0.5) -> Dict:
+    """
+    Counts for one page: true positives, predictions, references and how
+    many matched pairs also agree on the label. Regions are dicts with
+    'bbox' and 'label'; sum the counts over pages and pass them to
+    precision_recall for dataset-level numbers.
+    """
+    pairs = match_boxes([r["bbox"] for r in predicted], [r["bbox"] for r in reference], iou_threshold)
+    return {
+        "matched": len(pairs),
+        "label_matched": sum(predicted[p]["label"] == reference[r]["label"] for p, r in pairs),
+        "predicted": len(predicted),
+        "reference": len(reference),
+    }
+
+
+def precision_recall(counts: Dict) -> Dict:
+    precision = counts["matched"] / counts["predicted"] if counts["predicted"] else 0.0
+    recall = counts["matched"] / counts["reference"] if counts["reference"] else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    label_accuracy = counts["label_matched"] / counts["matched"] if counts["matched"] else 0.0
+    return {"precision": precision, "recall": recall, "f1": f1, "label_accuracy": label_accuracy}
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance between two strings (insertions, deletions and substitutions all cost 1)."""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def reading_order_text(regions: List[Dict]) -> str:
+    """
+    Region texts in reading order (page, then top to bottom, then left to
+    right), one per line. Regions are dicts with 'bbox', 'text' and
+    optionally 'page'.
+    """
+    ordered = sorted(regions, key=lambda region: (region.get("page", 0), region["bbox"][1], region["bbox"][0]))
+    return "\n".join(region["text"] for region in ordered if (region.get("text") or "").strip())
+
+
+def reference_text(fields: List[Dict]) -> str:
+    """Annotated field texts in reading order, one per line."""
+    return reading_order_text(fields)
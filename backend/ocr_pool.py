@@ -0,0 +1,312 @@
+# Dedicated worker processes for OCR
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from typing import Callable, Dict, List
+
+pool_size = int(os.getenv("OCR_WORKERS", "2"))
+# jobs allowed to wait for a free worker before new uploads are turned away
+max_pending = int(os.getenv("OCR_MAX_PENDING", "8"))
+# seconds a turned-away upload is told to wait (Retry-After) before trying again
+retry_after = int(os.getenv("OCR_RETRY_AFTER", "30"))
+# torch intra-op threads per worker so workers don't fight over the same cores
+worker_threads = int(os.getenv("OCR_WORKER_THREADS", str(max(1, (os.cpu_count() or 1) // max(pool_size, 1)))))
+# workers send their detector passes to one shared process, where pages from concurrent uploads are batched
+# (OCR_DETECT_BATCH_SIZE, OCR_DETECT_MAX_LATENCY_MS); 0 has every worker run the detector itself, unbatched
+shared_detector = os.getenv("OCR_SHARED_DETECTOR", "1") == "1"
+# torch intra-op threads for the shared detector process
+detector_threads = int(os.getenv("OCR_DETECTOR_THREADS", str(worker_threads)))
+
+logger = logging.getLogger(__name__)
+
+
+class OCRPoolFull(Exception):
+    """Raised when max_pending jobs are already waiting for a worker."""
+
+
+def _serve_detection(client):
+    # one thread per connected worker; the threads meet in detect_batcher, which batches their pages
+    import torch
+    import ocr_pipeline
+    with client:
+        while True:
+            try:
+                image = client.recv()
+            except (EOFError, OSError):
+                return  # the worker exited or was recycled
+            if image is None:
+                client.send(ocr_pipeline.detect_batcher.stats())
+                continue
+            try:
+                model = ocr_pipeline.registry.get_cnn_model()
+                if model is None:
+                    raise FileNotFoundError(f"Model weights not found at {ocr_pipeline.model_state_path}")
+                output = ocr_pipeline.detect_batcher.submit(model, torch.from_numpy(image))
+                client.send(("ok", tuple(grid.numpy() for grid in output)))
+            except Exception as exc:
+                client.send(("error", str(exc)))
+
+
+def _detector_main(conn, threads: int):
+    # runs in the child process: the detector for every worker, behind one DetectionBatcher
+    import torch
+    torch.set_num_threads(threads)
+    import ocr_pipeline
+
+    listener = Listener(authkey=bytes(multiprocessing.current_process().authkey))
+    conn.send(listener.address)
+    conn.close()
+    try:
+        ocr_pipeline.registry.get_cnn_model()  # loads and warms up the detector
+    except Exception as exc:
+        logger.warning("Shared detector warmup failed: %s", exc)
+    while True:
+        try:
+            client = listener.accept()
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as exc:
+            logger.warning("Shared detector refused a connection: %s", exc)
+            continue
+        threading.Thread(target=_serve_detection, args=(client,), daemon=True).start()
+
+
+def _worker_main(conn, threads: int, detector_address):
+    # runs in the child process: load the models once, then serve jobs until told to stop
+    import torch
+    torch.set_num_threads(threads)
+    import ocr_pipeline
+
+    if detector_address is not None:
+        ocr_pipeline.use_shared_detector(detector_address, bytes(multiprocessing.current_process().authkey))
+    else:
+        # one job at a time means no other request's page ever joins a detection batch here;
+        # batching would only make every detection wait out its latency window
+        ocr_pipeline.detect_batcher.max_batch = 1
+
+    try:
+        ocr_pipeline.warmup_models()
+    except Exception as exc:
+        logger.warning("OCR worker warmup failed: %s", exc)
+    conn.send(("ready", None))
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        file_path, trace = job
+        try:
+            # regions go back to the API process as they're recognized, ahead of the full result
+            result = ocr_pipeline.extract_document_text(
+                file_path, on_region=lambda region: conn.send(("region", region)), trace=trace
+            )
+        except Exception as exc:
+            result = {"text": "", "regions": [], "error": str(exc)}
+        conn.send(("result", result))
+
+
+class _Worker:
+    def __init__(self, ctx, index: int, detector_address=None):
+        self.index = index
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child_conn, worker_threads, detector_address),
+            name=f"ocr-worker-{index}", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.started_at = time.monotonic()
+        self.busy_since: float | None = None
+        self.busy_seconds = 0.0
+        self.jobs = 0
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        busy = self.busy_seconds + (now - self.busy_since if self.busy_since is not None else 0.0)
+        uptime = now - self.started_at
+        return {
+            "index": self.index,
+            "pid": self.process.pid,
+            "alive": self.process.is_alive(),
+            "ready": self.ready,
+            "busy": self.busy_since is not None,
+            "jobs": self.jobs,
+            "uptime_seconds": round(uptime, 1),
+            "utilization": round(busy / uptime, 4) if uptime > 0 else 0.0,
+        }
+
+    def kill(self):
+        self.process.terminate()
+        self.process.join(timeout=2)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(timeout=2)
+        self.conn.close()
+
+
+class OCRProcessPool:
+    """
+    Runs extract_document_text in a fixed set of worker processes.
+
+    Each worker preloads the CNN and doctr once and handles one job at a
+    time, so OCR neither holds the GIL nor competes for torch threads inside
+    the API process. A job that misses its deadline gets its worker killed
+    and replaced, which actually frees the CPU instead of leaving a thread
+    running in the background.
+
+    With shared_detector, the workers' detector passes run in one more
+    process, so pages from concurrent uploads share batched forward passes.
+    A worker that can't reach it detects on its own.
+    """
+
+    def __init__(self, size: int, max_pending: int, shared_detector: bool = False):
+        self.size = size
+        self.max_pending = max_pending
+        self.shared_detector = shared_detector
+        self.waiting = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.recycled = 0
+        self._ctx = multiprocessing.get_context("spawn")  # fork + torch threads is unsafe
+        self._workers: List[_Worker] = []
+        self._idle: asyncio.Queue | None = None
+        self._detector = None
+        self._detector_address = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._idle is not None
+
+    @property
+    def full(self) -> bool:
+        """Whether run() would turn a job away right now."""
+        return self.enabled and self.waiting - self._idle.qsize() >= self.max_pending
+
+    async def start(self):
+        from ocr_pipeline import detect_batch_size
+        if self.shared_detector and detect_batch_size > 1:
+            conn, child_conn = self._ctx.Pipe()
+            self._detector = self._ctx.Process(
+                target=_detector_main, args=(child_conn, detector_threads), name="ocr-detector", daemon=True
+            )
+            self._detector.start()
+            child_conn.close()
+            self._detector_address = await asyncio.to_thread(conn.recv)
+            conn.close()
+        self._idle = asyncio.Queue()
+        for index in range(self.size):
+            worker = _Worker(self._ctx, index, self._detector_address)
+            self._workers.append(worker)
+            self._idle.put_nowait(worker)
+
+    async def stop(self):
+        for worker in self._workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self._workers:
+            await asyncio.to_thread(worker.process.join, 5)
+            if worker.process.is_alive():
+                await asyncio.to_thread(worker.kill)
+        if self._detector is not None:
+            # holds no state beyond the model
+            self._detector.terminate()
+            await asyncio.to_thread(self._detector.join, 5)
+        self._workers = []
+        self._idle = None
+        self._detector = self._detector_address = None
+
+    async def _replace(self, worker: _Worker):
+        self.recycled += 1
+        replacement = _Worker(self._ctx, worker.index, self._detector_address)
+        self._workers[self._workers.index(worker)] = replacement
+        self._idle.put_nowait(replacement)
+        # terminate + join can take seconds; the replacement is already serving, and the kill
+        # finishes in its thread even if this task is cancelled while waiting for it
+        await asyncio.to_thread(worker.kill)
+
+    async def run(self, file_path: str, timeout: float | None = None,
+                  on_region: Callable[[Dict], None] | None = None, trace: bool = False) -> Dict:
+        """
+        OCR file_path in a worker. Raises OCRPoolFull or asyncio.TimeoutError.
+        on_region is called on the event loop with each region the worker streams back.
+        """
+        if self.full:
+            self.rejected += 1
+            raise OCRPoolFull(f"{self.waiting} OCR jobs already waiting for a worker")
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        self.waiting += 1
+        try:
+            worker = await asyncio.wait_for(self._idle.get(), timeout=timeout)
+        finally:
+            self.waiting -= 1
+
+        worker.busy_since = time.monotonic()
+        try:
+            worker.conn.send((file_path, trace))
+            while True:
+                remaining = None if deadline is None else max(deadline - time.monotonic(), 0.0)
+                if not await asyncio.to_thread(worker.conn.poll, remaining):
+                    self.timeouts += 1
+                    raise asyncio.TimeoutError()
+                kind, payload = worker.conn.recv()
+                if kind == "ready":
+                    worker.ready = True
+                    continue
+                if kind == "region":
+                    if on_region is not None:
+                        on_region(payload)
+                    continue
+                break
+        except BaseException as exc:
+            # timed out, cancelled or the worker died mid-job: its state is unknown, so recycle it
+            worker.busy_seconds += time.monotonic() - worker.busy_since
+            worker.busy_since = None
+            if not isinstance(exc, asyncio.TimeoutError):
+                logger.warning("OCR worker %s failed on %s: %r", worker.index, file_path, exc)
+            await self._replace(worker)
+            # TimeoutError is an OSError subclass, so check it first
+            if isinstance(exc, (EOFError, OSError)) and not isinstance(exc, asyncio.TimeoutError):
+                return {"text": "", "regions": [], "error": "OCR worker crashed"}
+            raise
+
+        worker.busy_seconds += time.monotonic() - worker.busy_since
+        worker.busy_since = None
+        worker.jobs += 1
+        self._idle.put_nowait(worker)
+        return payload
+
+    def stats(self) -> Dict:
+        return {
+            "size": self.size,
+            "waiting": self.waiting,
+            "max_pending": self.max_pending,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "recycled": self.recycled,
+            "workers": [worker.stats() for worker in self._workers],
+        }
+
+    def detector_stats(self) -> Dict | None:
+        """The shared detector process's batching stats; None when workers detect on their own. Blocking."""
+        if self._detector_address is None:
+            return None
+        try:
+            with Client(self._detector_address, authkey=bytes(multiprocessing.current_process().authkey)) as conn:
+                conn.send(None)
+                return conn.recv()
+        except (OSError, EOFError) as exc:
+            logger.warning("Shared detector stats unavailable: %s", exc)
+            return None
+
+
+ocr_pool = OCRProcessPool(pool_size, max_pending, shared_detector)
@@ -0,0 +1,159 @@
+# Per-document OCR regions kept on disk as arrays, with a grid index for bbox lookups
+
+import os
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from file_cache import FileCache
+
+# side of a spatial index cell in page pixels; a typical form field spans one or two cells
+cell_size = int(os.getenv("REGION_INDEX_CELL", "128"))
+# loaded stores kept in memory
+store_cache_entries = int(os.getenv("REGION_STORE_CACHE", "256"))
+
+
+def regions_path(original_file_path: str) -> str:
+    """Where a document's region store lives: next to its upload."""
+    return os.path.join(os.path.dirname(original_file_path), "regions.npz")
+
+
+class RegionStore:
+    """
+    The regions extract_document_text found in one document, as parallel arrays.
+
+    boxes is (N, 4) int32 x1, y1, x2, y2 in source-page pixels, pages/labels
+    index into the page table and label_names, and texts are one UTF-8 blob
+    plus offsets. A uniform grid (cell_size pixels per cell, per page) maps
+    each cell to the regions touching it, so a bbox query only tests the
+    regions near it.
+    """
+
+    def __init__(self, boxes: np.ndarray, pages: np.ndarray, labels: np.ndarray, label_names: List[str],
+                 scores: np.ndarray, confidences: np.ndarray, texts: List[str], page_sizes: np.ndarray):
+        self.boxes = boxes
+        self.pages = pages
+        self.labels = labels
+        self.label_names = label_names
+        self.scores = scores
+        self.confidences = confidences
+        self.texts = texts
+        self.page_sizes = page_sizes
+        self._lowered = [text.lower() for text in texts]
+        self._grid = self._build_grid()
+        # highest occupied cell per page: queries reaching past it (a huge bbox) are clipped to it
+        self._extents: Dict[int, Tuple[int, int]] = {}
+        for page, gx, gy in self._grid:
+            max_gx, max_gy = self._extents.get(page, (0, 0))
+            self._extents[page] = (max(max_gx, gx), max(max_gy, gy))
+
+    @classmethod
+    def from_extraction(cls, extraction: Dict) -> "RegionStore":
+        regions = extraction.get("regions", [])
+        label_names = sorted({region.get("label", "other") for region in regions})
+        label_ids = {name: index for index, name in enumerate(label_names)}
+        page_sizes = np.array(
+            [(page.get("width", 0), page.get("height", 0)) for page in extraction.get("pages", [])], dtype=np.int32
+        ).reshape(-1, 2)
+        confidences = [region.get("ocr_confidence") for region in regions]
+        return cls(
+            boxes=np.array([region["bbox"] for region in regions], dtype=np.int32).reshape(-1, 4),
+            pages=np.array([region.get("page", 0) for region in regions], dtype=np.int16),
+            labels=np.array([label_ids[region.get("label", "other")] for region in regions], dtype=np.int8),
+            label_names=label_names,
+            scores=np.array([region.get("score", 0.0) for region in regions], dtype=np.float32),
+            confidences=np.array([np.nan if c is None else c for c in confidences], dtype=np.float32),
+            texts=[region.get("text", "") or "" for region in regions],
+            page_sizes=page_sizes,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "RegionStore":
+        with np.load(path, allow_pickle=False) as data:
+            blob = data["text_blob"].tobytes()
+            offsets = data["text_offsets"]
+            texts = [blob[start:end].decode("utf-8") for start, end in zip(offsets[:-1], offsets[1:])]
+            return cls(
+                boxes=data["boxes"], pages=data["pages"], labels=data["labels"],
+                label_names=[str(name) for name in data["label_names"]],
+                scores=data["scores"], confidences=data["confidences"], texts=texts,
+                page_sizes=data["page_sizes"],
+            )
+
+    def save(self, path: str):
+        encoded = [text.encode("utf-8") for text in self.texts]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(text) for text in encoded])
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            boxes=self.boxes, pages=self.pages, labels=self.labels,
+            label_names=np.array(self.label_names, dtype=str),
+            scores=self.scores, confidences=self.confidences,
+            text_blob=np.frombuffer(b"".join(encoded), dtype=np.uint8), text_offsets=offsets,
+            page_sizes=self.page_sizes,
+        )
+        os.replace(tmp_path, path)
+
+    def __len__(self) -> int:
+        return self.boxes.shape[0]
+
+    def _build_grid(self) -> Dict[Tuple[int, int, int], np.ndarray]:
+        cells: Dict[Tuple[int, int, int], List[int]] = {}
+        for index, ((x1, y1, x2, y2), page) in enumerate(zip(self.boxes.tolist(), self.pages.tolist())):
+            for gy in range(y1 // cell_size, max(y2 - 1, y1) // cell_size + 1):
+                for gx in range(x1 // cell_size, max(x2 - 1, x1) // cell_size + 1):
+                    cells.setdefault((page, gx, gy), []).append(index)
+        return {key: np.array(indices, dtype=np.int64) for key, indices in cells.items()}
+
+    def _candidates(self, bbox: Tuple[int, int, int, int], page: Optional[int]) -> np.ndarray:
+        x1, y1, x2, y2 = bbox
+        pages = [page] if page is not None else range(len(self.page_sizes) or 1)
+        found = [
+            self._grid[key]
+            for p in pages if p in self._extents
+            for gy in range(max(y1, 0) // cell_size, min(max(y2 - 1, y1, 0) // cell_size, self._extents[p][1]) + 1)
+            for gx in range(max(x1, 0) // cell_size, min(max(x2 - 1, x1, 0) // cell_size, self._extents[p][0]) + 1)
+            if (key := (p, gx, gy)) in self._grid
+        ]
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.int64)
+
+    def query(self, bbox: Optional[Tuple[int, int, int, int]] = None, label: Optional[str] = None,
+              page: Optional[int] = None, text: Optional[str] = None) -> np.ndarray:
+        """Indices of regions overlapping bbox, with the given label/page, whose text contains `text` (any case)."""
+        if bbox is not None:
+            indices = self._candidates(bbox, page)
+            x1, y1, x2, y2 = bbox
+            boxes = self.boxes[indices]
+            overlap = (boxes[:, 0] < x2) & (boxes[:, 2] > x1) & (boxes[:, 1] < y2) & (boxes[:, 3] > y1)
+            indices = indices[overlap]
+        else:
+            indices = np.arange(len(self))
+        if page is not None:
+            indices = indices[self.pages[indices] == page]
+        if label is not None:
+            if label not in self.label_names:
+                return np.zeros(0, dtype=np.int64)
+            indices = indices[self.labels[indices] == self.label_names.index(label)]
+        if text:
+            needle = text.lower()
+            indices = np.array([i for i in indices.tolist() if needle in self._lowered[i]], dtype=np.int64)
+        return indices
+
+    def regions(self, indices: np.ndarray) -> List[Dict]:
+        return [
+            {
+                "page": int(self.pages[i]),
+                "bbox": self.boxes[i].tolist(),
+                "label": self.label_names[self.labels[i]],
+                "score": float(self.scores[i]),
+                "ocr_confidence": None if np.isnan(self.confidences[i]) else float(self.confidences[i]),
+                "text": self.texts[i],
+            }
+            for i in indices.tolist()
+        ]
+
+    def page_info(self) -> List[Dict]:
+        return [{"page": index, "width": int(w), "height": int(h)} for index, (w, h) in enumerate(self.page_sizes.tolist())]
+
+
+region_stores = FileCache(RegionStore.load, store_cache_entries)
@@ -0,0 +1,166 @@
+# Per-document BM25 chunk index, so prompts carry the relevant part of a document instead of all of it
+
+import hashlib
+import json
+import math
+import os
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from file_cache import FileCache
+
+# rough size of one chunk; a chunk closes at the first region/line boundary past it
+chunk_tokens = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "200"))
+# most document tokens sent with one question (and with each validation call)
+context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# chunks considered per question before the budget is applied
+top_k = int(os.getenv("RETRIEVAL_TOP_K", "8"))
+# loaded indexes kept in memory
+index_cache_entries = int(os.getenv("RETRIEVAL_INDEX_CACHE", "256"))
+# BM25 term-frequency saturation and length normalization
+bm25_k1 = 1.5
+bm25_b = 0.75
+
+_word = re.compile(r"\w+", re.UNICODE)
+
+
+def chunks_path(original_file_path: str) -> str:
+    """Where a document's chunk index lives: next to its upload."""
+    return os.path.join(os.path.dirname(original_file_path), "chunks.json")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English with the OpenAI tokenizers, good enough for budgeting
+    return max(1, len(text) // 4)
+
+
+def text_digest(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _terms(text: str) -> List[str]:
+    return [term.lower() for term in _word.findall(text)]
+
+
+def _split_long(text: str, page: Optional[int]) -> List[Dict]:
+    # a full-page region or a paragraph with no line breaks becomes word windows of about chunk_tokens
+    words = text.split()
+    per_chunk = max(1, chunk_tokens * 3 // 4)
+    return [{"text": " ".join(words[start:start + per_chunk]), "page": page} for start in range(0, len(words), per_chunk)]
+
+
+def _pack(pieces: List[Tuple[str, Optional[int]]]) -> List[Dict]:
+    """Merge consecutive (text, page) pieces into chunks of about chunk_tokens, never across pages."""
+    chunks: List[Dict] = []
+    current: List[str] = []
+    current_page: Optional[int] = None
+    size = 0
+
+    def close():
+        if current:
+            chunks.append({"text": "\n".join(current), "page": current_page})
+            current.clear()
+
+    for text, page in pieces:
+        text = text.strip()
+        if not text:
+            continue
+        tokens = estimate_tokens(text)
+        if current and (page != current_page or size + tokens > chunk_tokens):
+            close()
+            size = 0
+        if tokens > chunk_tokens:
+            chunks.extend(_split_long(text, page))
+            continue
+        current_page = page
+        current.append(text)
+        size += tokens
+    close()
+    return chunks
+
+
+def chunk_extraction(extraction: Dict) -> List[Dict]:
+    """Chunks from the OCR regions, in reading order, each tagged with its page."""
+    return _pack([(region.get("text", "") or "", region.get("page")) for region in extraction.get("regions", [])])
+
+
+def chunk_text(text: str) -> List[Dict]:
+    """Chunks from plain text (translated documents, or documents stored before the index existed)."""
+    return _pack([(line, None) for line in text.splitlines()])
+
+
+class ChunkIndex:
+    """
+    BM25 over one document's chunks. Only the chunk texts are stored
+    (chunks.json); term statistics are rebuilt when the index is loaded,
+    which is cheap next to reading the file.
+    """
+
+    def __init__(self, chunks: List[Dict], digest: str):
+        self.chunks = chunks
+        self.digest = digest
+        self.tokens = [estimate_tokens(chunk["text"]) for chunk in chunks]
+        self._tf = [Counter(_terms(chunk["text"])) for chunk in chunks]
+        self._lengths = [sum(tf.values()) for tf in self._tf]
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        df = Counter(term for tf in self._tf for term in tf)
+        n = len(chunks)
+        self._idf = {term: math.log(1 + (n - count + 0.5) / (count + 0.5)) for term, count in df.items()}
+
+    @classmethod
+    def build(cls, text: str, extraction: Optional[Dict] = None) -> "ChunkIndex":
+        """Index for the stored document text; the OCR regions are used when that text came straight from them."""
+        if extraction and extraction.get("regions") and (extraction.get("text") or "") == text:
+            chunks = chunk_extraction(extraction)
+        else:
+            chunks = chunk_text(text)
+        return cls(chunks, text_digest(text))
+
+    @classmethod
+    def load(cls, path: str) -> "ChunkIndex":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(data["chunks"], data["digest"])
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"digest": self.digest, "chunks": self.chunks}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def scores(self, query: str) -> List[float]:
+        terms = [term for term in set(_terms(query)) if term in self._idf]
+        scores = []
+        for tf, length in zip(self._tf, self._lengths):
+            norm = bm25_k1 * (1 - bm25_b + bm25_b * length / self._avg_length) if self._avg_length else bm25_k1
+            scores.append(sum(self._idf[t] * tf[t] * (bm25_k1 + 1) / (tf[t] + norm) for t in terms if t in tf))
+        return scores
+
+    def select(self, query: str, budget: int = context_token_budget, k: int = top_k) -> List[Dict]:
+        """
+        The top-k chunks for query that fit in budget tokens, in document
+        order. A document that fits in the budget is returned whole; a query
+        that matches nothing gets the document's opening chunks.
+        """
+        if sum(self.tokens) <= budget:
+            return list(self.chunks)
+        scores = self.scores(query)
+        ranked = [i for i in sorted(range(len(self.chunks)), key=lambda i: -scores[i]) if scores[i] > 0][:k]
+        if not ranked:
+            ranked = list(range(len(self.chunks)))
+        chosen, used = [], 0
+        for i in ranked:
+            if used + self.tokens[i] > budget:
+                continue
+            chosen.append(i)
+            used += self.tokens[i]
+        return [self.chunks[i] for i in sorted(chosen)]
+
+
+def format_context(chunks: List[Dict]) -> str:
+    """Selected chunks as prompt text; gaps between them are marked so the model knows text was left out."""
+    return "\n[...]\n".join(chunk["text"] for chunk in chunks)
+
+
+chunk_indexes = FileCache(ChunkIndex.load, index_cache_entries)
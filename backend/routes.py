@@ -1,29 +1,49 @@
 # Endpoint Code
 from fastapi import FastAPI, Depends, HTTPException, Form, File, UploadFile
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from database import database, engine
-from schemas import LoginRequest, LoginResponse, RegisterRequest, RegisterResponse, SendMessageRequest, SendMessageResponse, DocumentResponse, UpdateUserRequest, UpdateUserResponse, UpdateChatRequest, CreateChatFromDocumentRequest, DeleteDocumentResponse
+from schemas import LoginRequest, LoginResponse, RegisterRequest, RegisterResponse, SendMessageRequest, SendMessageResponse, DocumentResponse, UpdateUserRequest, UpdateUserResponse, UpdateChatRequest, CreateChatFromDocumentRequest, DeleteDocumentResponse, DocumentRegionsResponse
 from crud.user_crud import UserCRUD
 from crud.document_crud import DocumentCRUD
 from crud.message_crud import MessageCRUD
 from crud.chat_crud import ChatCRUD
 from passlib.context import CryptContext
 from contextlib import asynccontextmanager
-from helpers import saveFile, get_gpt_response_with_context, check_logic_with_gemini, translate_text
-from ocr_pipeline import extract_document_text
+from contextlib import aclosing
+from helpers import saveFile, get_gpt_response_with_context_async, stream_gpt_response_with_context_async, check_logic_with_gemini_async, translate_text_async, close_llm_clients
+from ocr_pipeline import detect_batcher, extract_document_text, ocr_fingerprint, record_metrics, warmup_models
+from ocr_cache import result_cache
+from ocr_pool import OCRPoolFull, ocr_pool, retry_after as ocr_retry_after
+from region_store import RegionStore, region_stores, regions_path
+from retrieval import ChunkIndex, chunk_indexes, chunks_path, format_context, text_digest
+from answer_cache import answer_cache
+import metrics
 import asyncio
+import json
 import logging
 import requests
 import secrets
+import shutil
 import os
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await database.connect()
+    if ocr_pool.size > 0:
+        # workers load and warm up the models themselves
+        await ocr_pool.start()
+    else:
+        try:
+            # load the detector + doctr once and run a dummy pass so the first upload doesn't pay for it
+            await asyncio.to_thread(warmup_models)
+        except Exception as exc:
+            logger.warning('OCR model warmup failed: %s', exc)
     yield
+    await close_llm_clients()
+    await ocr_pool.stop()
     await database.disconnect()
 
 app = FastAPI(lifespan=lifespan)
@@ -69,6 +89,208 @@ def get_google_config():
 
 logger = logging.getLogger(__name__)
 
+# lets a client ask for a profiled OCR run with the `trace` form field
+ocr_trace_requests = os.getenv("OCR_TRACE_REQUESTS", "0") == "1"
+
+# candidate answers generated and checked at the same time for one message (1 asks one after another)
+send_message_fanout = max(int(os.getenv("SEND_MESSAGE_FANOUT", "3")), 1)
+# most candidates (one GPT and one Gemini call each) a single message may cost
+send_message_max_candidates = int(os.getenv("SEND_MESSAGE_MAX_CANDIDATES", "5"))
+
+answer_candidates = metrics.counter("answer_candidates_total", "Candidate answers, by how they ended")
+
+metrics.gauge("answer_cache_hit_rate", "Chat answers served from the answer cache / lookups", lambda: answer_cache.stats()["hit_rate"])
+metrics.gauge("answer_cache_near_hit_rate", "Chat answers served for a near-duplicate question / lookups", lambda: answer_cache.stats()["near_hit_rate"])
+metrics.gauge("ocr_cache_hit_rate", "OCR result cache hits / lookups", lambda: result_cache.stats()["hit_rate"])
+metrics.gauge("ocr_pool_waiting", "OCR jobs waiting for a worker", lambda: ocr_pool.waiting)
+
+async def run_ocr(file_path: str, timeout: float | None = None, on_region=None, trace: bool = False) -> dict:
+    """
+    OCR an upload, answering from the content-addressed cache when the same bytes were processed before.
+    on_region is called on the event loop with each region as soon as it is recognized.
+    trace skips the cache and profiles the run (see ocr_pipeline.set_trace_hook).
+    """
+    key = await asyncio.to_thread(result_cache.key_for, file_path, ocr_fingerprint())
+    cached = None if trace else await asyncio.to_thread(result_cache.get, key)
+    if cached is not None:
+        if on_region is not None:
+            for region in cached.get('regions', []):
+                on_region(region)
+        return cached
+
+    if ocr_pool.enabled:
+        # dedicated worker processes; a timeout kills the worker instead of leaving it running
+        extraction = await ocr_pool.run(file_path, timeout=timeout, on_region=on_region, trace=trace)
+    else:
+        thread_callback = None
+        if on_region is not None:
+            loop = asyncio.get_running_loop()
+            thread_callback = lambda region: loop.call_soon_threadsafe(on_region, region)
+        # ocr workload gets pushed into a background thread so fastAPI can handle other requests while it runs
+        extraction = await asyncio.wait_for(
+            asyncio.to_thread(extract_document_text, file_path, thread_callback, trace),
+            timeout=timeout
+        )
+    if isinstance(extraction, dict) and extraction.get('metrics'):
+        # observed here rather than in the pipeline so pool workers' runs land in this process's /metrics
+        record_metrics(extraction['metrics'])
+        if trace:
+            logger.info('OCR trace for %s: %s', file_path, extraction['metrics'].get('trace'))
+    if isinstance(extraction, dict) and not extraction.get('error'):
+        # timings describe this run only, so they aren't cached
+        cached_result = {k: v for k, v in extraction.items() if k != 'metrics'}
+        await asyncio.to_thread(result_cache.put, key, cached_result)
+    return extraction
+
+async def extract_upload(file_path: str, document_id: int, on_region=None, trace: bool = False) -> dict:
+    """
+    run_ocr for a fresh upload; failures and timeouts come back as an extraction with 'error' set.
+    OCRPoolFull is raised as is: the upload should be turned away, not stored without text.
+    """
+    try:
+        # Note: On CPU this can take 30-60+ seconds for large images
+        # Add timeout of 120 seconds for CPU inference
+        extraction = await run_ocr(file_path, timeout=120.0, on_region=on_region, trace=trace and ocr_trace_requests)
+        if not isinstance(extraction, dict):
+            extraction = {'text': str(extraction) if extraction else '', 'regions': [], 'error': None}
+        elif extraction.get('error'):
+            logger.warning('OCR issue for document %s: %s', document_id, extraction['error'])
+    except asyncio.TimeoutError:
+        logger.error('OCR extraction timed out after 120 seconds for document %s', document_id)
+        extraction = {'text': '', 'regions': [], 'error': 'OCR extraction timed out (CPU inference is slow)'}
+    except OCRPoolFull:
+        raise
+    except Exception as exc:
+        logger.warning('Failed to extract text for document %s: %s', document_id, exc)
+        extraction = {'text': '', 'regions': [], 'error': str(exc)}
+    return extraction
+
+def ocr_busy() -> HTTPException:
+    """503 for an upload the OCR pool has no room for, telling the client when to try again."""
+    return HTTPException(
+        status_code=503,
+        detail="Too many documents are being processed, please try again shortly",
+        headers={"Retry-After": str(ocr_retry_after)},
+    )
+
+def discard_upload(db: Session, document_id: int, original_file_path: str):
+    """Remove an upload that never got a usable chat (turned away, failed or abandoned), with its saved files."""
+    document = DocumentCRUD.get_by_id(db=db, document_id=document_id)
+    if document:
+        for chat in document.chats:
+            ChatCRUD.delete(db=db, chat_id=chat.id)
+    DocumentCRUD.delete(db=db, document_id=document_id)
+    shutil.rmtree(os.path.dirname(original_file_path), ignore_errors=True)
+
+async def finish_upload(db: Session | None, document_id: int, user_id: int, name: str, original_file_path: str,
+                        extraction: dict, target_language: str | None) -> tuple[int, str]:
+    """
+    Translate the OCR text if needed, store it with the document and open a chat on it. Returns the chat id
+    and the stored text. With db None the writes use a session of their own (for a response that is already
+    streaming, whose request session may be closed).
+    """
+    original_text = extraction.get('text', '') or ''
+    text = original_text
+
+    if original_text and target_language:
+        try:
+            # awaited on the async Gemini client, so no worker thread is involved
+            translated_text = await translate_text_async(original_text, target_language)
+            if translated_text:
+                text = translated_text
+        except Exception as exc:
+            logger.warning('Failed to translate document %s: %s', document_id, exc)
+
+    if extraction.get('error'):
+        logger.error('OCR failed for document %s: %s', document_id, extraction.get('error'))
+
+    await save_regions(document_id, original_file_path, extraction)
+    await save_chunks(document_id, original_file_path, text, extraction)
+
+    def store() -> int:
+        if db is None:
+            with Session(bind=engine) as own_db:
+                return store_upload(own_db, document_id, user_id, name, original_file_path, text, target_language)
+        return store_upload(db, document_id, user_id, name, original_file_path, text, target_language)
+
+    # file and DB writes block, so they run in a worker thread
+    return await asyncio.to_thread(store), text
+
+def store_upload(db: Session, document_id: int, user_id: int, name: str, original_file_path: str,
+                 text: str, target_language: str | None) -> int:
+    """finish_upload's writes: the text file next to the upload, the document's paths and text, and a new chat."""
+    translated_file_path = ''
+    if text:
+        translated_file_path = os.path.join(os.path.dirname(original_file_path), f'translated_{(target_language or "default").replace(" ", "_").lower()}.txt')
+        try:
+            # persist translated text alongside the upload
+            with open(translated_file_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        except Exception as exc:
+            logger.warning('Failed to write translated text file for document %s: %s', document_id, exc)
+            translated_file_path = ""
+
+    DocumentCRUD.add_file_paths(db=db, document_id=document_id, original_file_path=original_file_path, translated_file_path=translated_file_path)
+    DocumentCRUD.add_text(db=db, document_id=document_id, text=text or "")
+
+    chat_name = ChatCRUD.generate_chat_name(db=db, user_id=user_id, document_id=document_id, base_name=name)
+    return ChatCRUD.create(db=db, user_id=user_id, document_id=document_id, chat_name=chat_name).id
+
+async def save_regions(document_id: int, original_file_path: str, extraction: dict):
+    """Keep the extraction's regions next to the upload so layout lookups never need OCR again."""
+    if not extraction.get('regions'):
+        return
+    try:
+        store = RegionStore.from_extraction(extraction)
+        await asyncio.to_thread(region_stores.save, regions_path(original_file_path), store)
+    except Exception as exc:
+        logger.warning('Failed to store regions for document %s: %s', document_id, exc)
+
+async def save_chunks(document_id: int, original_file_path: str, text: str, extraction: dict | None = None):
+    """Index the stored document text for retrieval once, at ingest, instead of on every message."""
+    if not text or not original_file_path:
+        return
+    try:
+        index = ChunkIndex.build(text, extraction)
+        await asyncio.to_thread(chunk_indexes.save, chunks_path(original_file_path), index)
+    except Exception as exc:
+        logger.warning('Failed to index chunks for document %s: %s', document_id, exc)
+
+def document_context(document, question: str) -> str:
+    """The chunks of a document's text most relevant to question, within CONTEXT_TOKEN_BUDGET."""
+    text = document.text or ""
+    if not text.strip():
+        return text
+    path = chunks_path(document.original_file_path) if document.original_file_path else None
+    index = None
+    if path:
+        try:
+            index = chunk_indexes.get(path)
+        except Exception as exc:
+            logger.warning('Failed to load chunks for document %s: %s', document.id, exc)
+    if index is None or index.digest != text_digest(text):
+        # documents stored before the index existed, or whose text changed since
+        index = ChunkIndex.build(text)
+        if path:
+            try:
+                chunk_indexes.save(path, index)
+            except OSError as exc:
+                logger.warning('Failed to save chunks for document %s: %s', document.id, exc)
+    return format_context(index.select(question))
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get("/ocr/stats")
+def get_ocr_stats():
+    stats = {"cache": result_cache.stats(), "pool": ocr_pool.stats()}
+    # with the pool, detection is batched in its shared detector process, not by this process's batcher
+    detect_batching = ocr_pool.detector_stats() if ocr_pool.enabled else detect_batcher.stats()
+    if detect_batching is not None:
+        stats["detect_batching"] = detect_batching
+    return stats
+
 @app.post("/register", response_model=RegisterResponse)
 async def register(request : RegisterRequest, db : Session = Depends(get_db)):
     user = UserCRUD.get_by_email(db=db, email=request.email)
@@ -233,6 +455,7 @@ async def create_chat(
     name: str = Form(...),
     language: str | None = Form(None),
     file: UploadFile = File(...),
+    trace: bool = Form(False),
     db: Session = Depends(get_db)
 ):
     
@@ -243,6 +466,9 @@ async def create_chat(
 
     target_language = (language or user.language or '').strip() or None
 
+    if ocr_pool.full:
+        raise ocr_busy()
+
     file_info = {
         'filename': file.filename,
         'media_type': file.content_type,
@@ -253,110 +479,293 @@ async def create_chat(
 
     original_file_path = await saveFile(file=file, user_id=user_id, document_id=document.id, type="original")
 
-    text = ''
-    original_text = ''
-    translated_file_path = ''
-    extraction = None
     try:
-        # ocr workload gets pushed into a background thread so fastAPI can handle other requests while it runs
-        # Note: On CPU this can take 30-60+ seconds for large images
-        # Add timeout of 120 seconds for CPU inference
-        extraction = await asyncio.wait_for(
-            asyncio.to_thread(extract_document_text, original_file_path),
-            timeout=120.0
-        )
-        if isinstance(extraction, dict):
-            original_text = extraction.get('text', '') or ''
-            if extraction.get('error'):
-                logger.warning('OCR issue for document %s: %s', document.id, extraction['error'])
-        else:
-            original_text = str(extraction) if extraction else ''
-    except asyncio.TimeoutError:
-        logger.error('OCR extraction timed out after 120 seconds for document %s', document.id)
-        extraction = {'text': '', 'regions': [], 'error': 'OCR extraction timed out (CPU inference is slow)'}
-        original_text = ''
-    except Exception as exc:
-        logger.warning('Failed to extract text for document %s: %s', document.id, exc)
-        extraction = {'text': '', 'regions': [], 'error': str(exc)}
-        original_text = ''
+        extraction = await extract_upload(original_file_path, document.id, trace=trace)
+    except OCRPoolFull:
+        # the queue filled up between the check above and this upload's turn
+        await asyncio.to_thread(discard_upload, db, document.id, original_file_path)
+        raise ocr_busy()
+    chat_id, _ = await finish_upload(db, document.id, user_id, name, original_file_path, extraction, target_language)
 
-    text = original_text
+    return {"chat_id": chat_id}
 
-    if original_text and target_language:
-        try:
-            # translate in background thread
-            translated_text = await asyncio.to_thread(translate_text, original_text, target_language)
-            if translated_text:
-                text = translated_text
-        except Exception as exc:
-            logger.warning('Failed to translate document %s: %s', document.id, exc)
+@app.post("/create_chat/stream")
+async def create_chat_stream(
+    user_id: int = Form(...),
+    name: str = Form(...),
+    language: str | None = Form(None),
+    file: UploadFile = File(...),
+    trace: bool = Form(False),
+    db: Session = Depends(get_db)
+):
+    """
+    Same as /create_chat, but answers with newline-delimited JSON events as OCR progresses:
+    one "document" event, a "region" event per recognized region, then "done" with the chat id.
+    An upload that ends without a chat (the OCR queue filled up, it failed, or the client left) is
+    removed again; an "error" event for a full queue carries retry_after.
+    """
+    user = UserCRUD.get_by_id(db=db, user_id=user_id)
+    if not user:
+        raise HTTPException(status_code=404, detail='User not found')
 
-    if extraction and extraction.get('error'):
-        logger.error('OCR failed for document %s: %s', document.id, extraction.get('error'))
+    target_language = (language or user.language or '').strip() or None
 
-    if text:
-        translated_file_path = os.path.join(os.path.dirname(original_file_path), f'translated_{(target_language or "default").replace(" ", "_").lower()}.txt')
-        try:
-            # persist translated text alongside the upload
-            with open(translated_file_path, 'w', encoding='utf-8') as f:
-                f.write(text)
-        except Exception as exc:
-            logger.warning('Failed to write translated text file for document %s: %s', document.id, exc)
-            translated_file_path = ""
+    if ocr_pool.full:
+        raise ocr_busy()
+
+    file_info = {
+        'filename': file.filename,
+        'media_type': file.content_type,
+        'target_language': target_language
+    }
+
+    document = DocumentCRUD.create(db=db, user_id=user_id, file_info=file_info)
+    document_id = document.id
 
-    DocumentCRUD.add_file_paths(db=db, document_id=document.id, original_file_path=original_file_path, translated_file_path=translated_file_path)
-    DocumentCRUD.add_text(db=db, document_id=document.id, text=text or "")
+    original_file_path = await saveFile(file=file, user_id=user_id, document_id=document_id, type="original")
 
-    chat_name = ChatCRUD.generate_chat_name(db=db, user_id=user_id, document_id=document.id, base_name=name)
-    chat = ChatCRUD.create(db=db, user_id=user_id, document_id=document.id, chat_name=chat_name)
+    def event(payload: dict) -> bytes:
+        return (json.dumps(payload) + "\n").encode("utf-8")
 
-    return {"chat_id": chat.id}
+    def discard():
+        with Session(bind=engine) as discard_db:
+            discard_upload(discard_db, document_id, original_file_path)
+
+    async def events():
+        yield event({"event": "document", "document_id": document_id})
+
+        regions: asyncio.Queue = asyncio.Queue()
+        finished = False
+
+        async def ocr_job():
+            try:
+                return await extract_upload(original_file_path, document_id, on_region=regions.put_nowait, trace=trace)
+            finally:
+                regions.put_nowait(None)
+
+        job = asyncio.create_task(ocr_job())
+        try:
+            while (region := await regions.get()) is not None:
+                yield event({
+                    "event": "region",
+                    "page": region.get("page", 0),
+                    "bbox": list(region["bbox"]),
+                    "label": region.get("label"),
+                    "score": region.get("score"),
+                    "text": region.get("text", ""),
+                })
+            extraction = await job
+
+            # the request's session may already be closed once streaming starts, so finish on our own
+            chat_id, text = await finish_upload(None, document_id, user_id, name, original_file_path, extraction, target_language)
+            finished = True
+            yield event({
+                "event": "done",
+                "chat_id": chat_id,
+                "document_id": document_id,
+                "text": text,
+                "error": extraction.get("error"),
+            })
+        except OCRPoolFull:
+            yield event({
+                "event": "error",
+                "document_id": document_id,
+                "detail": ocr_busy().detail,
+                "retry_after": ocr_retry_after,
+            })
+        except Exception as exc:
+            logger.error('Streaming upload failed for document %s: %s', document_id, exc)
+            yield event({"event": "error", "document_id": document_id, "detail": str(exc)})
+        finally:
+            # client went away mid-stream: don't leave the OCR job behind
+            if not job.done():
+                job.cancel()
+            if not finished:
+                # nor a document without text or chat in the user's /documents; shielded, since on a
+                # disconnect this task is being cancelled and any await here would be cancelled too
+                await asyncio.shield(asyncio.to_thread(discard))
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
 
 @app.post("/send_message")
-def send_message(request : SendMessageRequest, db : Session = Depends(get_db)):
+async def send_message(request : SendMessageRequest, db : Session = Depends(get_db)):
     chat_id = request.chat_id
     user_message = request.text
 
+    # Update Message Table & Chat Session History (in a worker thread: the DB driver blocks)
+    chat = await asyncio.to_thread(store_user_message, db, chat_id, user_message)
+
+    # a validated answer to the same question, on the same text and after the same turns, is reused as is
+    cache_scope = answer_cache.scope_for(text_digest(chat.document.text or ""), chat.message_history[:-1], request.language)
+    gpt_response = answer_cache.get(cache_scope, user_message)
+
+    if gpt_response is None:
+        document_text = await asyncio.to_thread(document_context, chat.document, retrieval_query(chat.message_history[:-1], user_message))
+        gpt_response, approved = await answer_with_validation(chat.message_history, user_message, document_text, request.language)
+        if approved:
+            answer_cache.put(cache_scope, user_message, gpt_response)
+
+    # Add GPT Message to Messages and Update the Chat (should also work for when nothing is found)
+    await asyncio.to_thread(store_message, db, chat_id, "assistant", gpt_response)
+
+    # Return the message
+    return gpt_response
+
+def chat_with_document(db: Session, chat_id: int):
+    """The chat with its document loaded, or a 404 if either is missing. Blocking: call it via asyncio.to_thread."""
     chat = ChatCRUD.get_by_id(db=db, chat_id=chat_id)
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found. Please upload a document first to start a chat.")
+    if not chat.document:
+        raise HTTPException(status_code=404, detail="Document not found for this chat")
+    return chat
 
-    # Update Message Table & Chat Session History
-    MessageCRUD.create(db=db, chat_id=chat_id, role="user", content=user_message)
-
-    chat = ChatCRUD.update_chat(db=db, chat_id=chat_id, message=user_message, role="user")
+def store_message(db: Session, chat_id: int, role: str, content: str):
+    """Add a message to the messages table and to the chat's history; returns the updated chat."""
+    MessageCRUD.create(db=db, chat_id=chat_id, role=role, content=content)
+    return ChatCRUD.update_chat(db=db, chat_id=chat_id, message=content, role=role)
 
+def store_user_message(db: Session, chat_id: int, user_message: str):
+    """
+    /send_message's first step: store the question, then return the chat with its document freshly
+    loaded, so nothing lazy-loads on the event loop afterwards. The question is stored before the
+    document check, as it always was.
+    """
+    chat = ChatCRUD.get_by_id(db=db, chat_id=chat_id)
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found. Please upload a document first to start a chat.")
+    chat = store_message(db, chat_id, "user", user_message)
     if not chat.document:
         raise HTTPException(status_code=404, detail="Document not found for this chat")
-    
     db.refresh(chat.document)
-    document_text = chat.document.text or ""
+    return chat
 
-    gemini_approved = False
-    gpt_response=""
-    retries = 0
-    # Get Response from GPT
-    while not gemini_approved and retries < 5:
+def retrieval_query(history: list, user_message: str) -> str:
+    # the previous question is part of the query so follow-ups ("and the second one?") find the same chunks
+    previous_questions = [m.get("content", "") for m in history if m.get("role") == "user"][-1:]
+    return " ".join(previous_questions + [user_message])
 
-        gpt_response = get_gpt_response_with_context(chat.message_history, document_text, language=request.language)
-
-        content = user_message + " " + gpt_response
+async def answer_with_validation(messages: list, user_message: str, document_text: str, language: str | None,
+                                 first_answer: str | None = None) -> tuple[str, bool]:
+    """
+    Generate candidate answers and have Gemini check each, send_message_fanout at a time, until one
+    is approved or send_message_max_candidates have been tried. The first approved candidate wins and
+    the others are cancelled. first_answer (an answer already streamed to the client) is checked on
+    its own before any new candidate is asked for. Returns the answer and whether it was approved.
+    """
+    async def approved(answer: str) -> bool:
+        content = user_message + " " + answer
+        return await check_logic_with_gemini_async(content=content, document_text=document_text, language=language)
+
+    async def candidate() -> tuple[str, bool]:
+        answer = await get_gpt_response_with_context_async(messages, document_text, language=language)
+        return answer, await approved(answer)
+
+    budget = send_message_max_candidates
+    if first_answer is not None:
+        budget -= 1
+        if await approved(first_answer):
+            answer_candidates.inc(outcome="approved")
+            return first_answer, True
+        answer_candidates.inc(outcome="rejected")
+
+    pending = set()
+    launched = 0
+    failures = []
+    try:
+        while pending or launched < budget:
+            while launched < budget and len(pending) < send_message_fanout:
+                pending.add(asyncio.create_task(candidate()))
+                launched += 1
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    answer, ok = task.result()
+                except Exception as exc:
+                    logger.warning('Answer candidate failed: %s', exc)
+                    answer_candidates.inc(outcome="failed")
+                    failures.append(exc)
+                    continue
+                answer_candidates.inc(outcome="approved" if ok else "rejected")
+                if ok:
+                    return answer, True
+    finally:
+        # also runs when the request itself is cancelled (client gone)
+        for task in pending:
+            task.cancel()
+            answer_candidates.inc(outcome="cancelled")
+
+    if failures and len(failures) == launched:
+        # every call errored (e.g. a bad API key): surface it rather than a non-answer
+        raise failures[-1]
+    # No consistence was reached between the two models
+    return "Unable to answer this question.", False
+
+@app.post("/send_message/stream")
+async def send_message_stream(request: SendMessageRequest, db: Session = Depends(get_db)):
+    """
+    Same as /send_message, but answers with server-sent events: a "token" event for each piece of
+    the GPT answer as it arrives, then one "validation" event once Gemini has checked it. Its status
+    is "validated", or "retracted" with the response that replaces the streamed one. An answer from
+    the answer cache comes as a single token event. Both messages are stored only once the answer
+    is final; nothing is stored if the client leaves early.
+    """
+    chat_id = request.chat_id
+    user_message = request.text
 
-        gemini_approved = check_logic_with_gemini(content=content, document_text=document_text, language=request.language)
+    chat = await asyncio.to_thread(chat_with_document, db, chat_id)
 
-        retries += 1
-    
-    if not gemini_approved and retries >= 5:
-        # No consistence was reached between the two models
-        gpt_response = "Unable to answer this question."
+    history = list(chat.message_history or [])
+    messages = history + [{"role": "user", "content": user_message}]
+    cache_scope = answer_cache.scope_for(text_digest(chat.document.text or ""), history, request.language)
+    cached = answer_cache.get(cache_scope, user_message)
+    document_text = "" if cached is not None else await asyncio.to_thread(
+        document_context, chat.document, retrieval_query(history, user_message)
+    )
 
-    # Add GPT Message to Messages and Update the Chat (should also work for when nothing is found)
-    MessageCRUD.create(db=db, chat_id=chat_id, role="assistant", content=gpt_response)
+    def event(name: str, payload: dict) -> bytes:
+        return f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode("utf-8")
 
-    chat = ChatCRUD.update_chat(db=db, chat_id=chat_id, message=gpt_response, role="assistant")
+    async def events():
+        try:
+            if cached is not None:
+                # already validated: sent whole, with no model calls
+                yield event("token", {"text": cached})
+                streamed = response = cached
+                approved = True
+            else:
+                parts = []
+                async with aclosing(stream_gpt_response_with_context_async(messages, document_text, language=request.language)) as tokens:
+                    async for token in tokens:
+                        parts.append(token)
+                        yield event("token", {"text": token})
+                streamed = "".join(parts)
+
+                response, approved = await answer_with_validation(
+                    messages, user_message, document_text, request.language, streamed
+                )
+                if approved:
+                    answer_cache.put(cache_scope, user_message, response)
+
+            def persist():
+                # the request's session may already be closed once streaming starts, so persist on our own
+                with Session(bind=engine) as stream_db:
+                    store_message(stream_db, chat_id, "user", user_message)
+                    store_message(stream_db, chat_id, "assistant", response)
+
+            await asyncio.to_thread(persist)
+
+            yield event("validation", {
+                "status": "validated" if approved and response == streamed else "retracted",
+                "response": response,
+                "chat_id": chat_id,
+                "cached": cached is not None,
+            })
+        except Exception as exc:
+            logger.error('Streaming answer failed for chat %s: %s', chat_id, exc)
+            yield event("error", {"chat_id": chat_id, "detail": str(exc)})
 
-    # Return the message
-    return gpt_response
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.get("/documents/{user_id}", response_model=list[DocumentResponse])
 def get_documents(user_id: int, db: Session = Depends(get_db)):
@@ -472,6 +881,37 @@ def delete_chat(chat_id: int, db: Session = Depends(get_db)):
     
     return {"success": True, "message": "Chat deleted successfully"}
 
+@app.get("/documents/{document_id}/regions", response_model=DocumentRegionsResponse)
+def get_document_regions(
+    document_id: int,
+    user_id: int,
+    bbox: str | None = None,  # "x1,y1,x2,y2": regions overlapping this box
+    label: str | None = None,
+    page: int | None = None,
+    text: str | None = None,  # case-insensitive substring of the region text
+    db: Session = Depends(get_db)
+):
+    """Look up a document's OCR regions (bbox, label, text) without touching the image, e.g. to highlight an answer."""
+    document = DocumentCRUD.get_by_id(db=db, document_id=document_id)
+    if not document or document.user_id != user_id:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    store = region_stores.get(regions_path(document.original_file_path)) if document.original_file_path else None
+    if store is None:
+        raise HTTPException(status_code=404, detail="No regions stored for this document")
+
+    box = None
+    if bbox:
+        try:
+            box = tuple(int(float(v)) for v in bbox.split(","))
+        except (ValueError, OverflowError):  # OverflowError: "inf"
+            box = ()
+        if len(box) != 4:
+            raise HTTPException(status_code=400, detail="bbox must be x1,y1,x2,y2")
+
+    indices = store.query(bbox=box, label=label, page=page, text=text)
+    return {"document_id": document_id, "pages": store.page_info(), "regions": store.regions(indices)}
+
 @app.delete("/documents/{document_id}", response_model=DeleteDocumentResponse)
 def delete_document(document_id: int, user_id: int, db: Session = Depends(get_db)):
     document = DocumentCRUD.get_by_id(db=db, document_id=document_id)
@@ -504,16 +944,19 @@ async def create_chat_from_document(request: CreateChatFromDocumentRequest, db:
     if not (document.text and document.text.strip()):
         original_text = ''
         text = ''
+        extraction = None
         translated_file_path = document.translated_file_path or ''
         try:
             if document.original_file_path:
-                extraction = await asyncio.to_thread(extract_document_text, document.original_file_path)
+                extraction = await run_ocr(document.original_file_path)
                 if isinstance(extraction, dict):
                     original_text = extraction.get('text', '') or ''
                     if extraction.get('error'):
                         logger.warning('OCR issue for document %s: %s', document.id, extraction['error'])
                 else:
                     original_text = str(extraction)
+        except OCRPoolFull:
+            raise ocr_busy()
         except Exception as exc:
             logger.warning('Failed to extract text for document %s: %s', document.id, exc)
 
@@ -521,7 +964,7 @@ async def create_chat_from_document(request: CreateChatFromDocumentRequest, db:
 
         if original_text and target_language:
             try:
-                translated_text = await asyncio.to_thread(translate_text, original_text, target_language)
+                translated_text = await translate_text_async(original_text, target_language)
                 if translated_text:
                     text = translated_text
             except Exception as exc:
@@ -530,6 +973,11 @@ async def create_chat_from_document(request: CreateChatFromDocumentRequest, db:
         if extraction and isinstance(extraction, dict) and extraction.get('error'):
             logger.error('OCR failed for document %s: %s', document.id, extraction.get('error'))
 
+        if isinstance(extraction, dict):
+            await save_regions(document.id, document.original_file_path, extraction)
+        if document.original_file_path:
+            await save_chunks(document.id, document.original_file_path, text, extraction if isinstance(extraction, dict) else None)
+
         if text:
             DocumentCRUD.add_text(db=db, document_id=document.id, text=text)
 
@@ -60,3 +60,24 @@ class CreateChatFromDocumentRequest(BaseModel):
 class DeleteDocumentResponse(BaseModel):
     success: bool
     message: str
+
+
+class RegionResponse(BaseModel):
+    page: int
+    bbox: list[int]  # x1, y1, x2, y2 in pixels of the original page
+    label: str
+    score: float
+    ocr_confidence: float | None = None
+    text: str
+
+
+class PageSizeResponse(BaseModel):
+    page: int
+    width: int
+    height: int
+
+
+class DocumentRegionsResponse(BaseModel):
+    document_id: int
+    pages: list[PageSizeResponse]  # page sizes, to scale boxes onto the rendered page
+    regions: list[RegionResponse]
@@ -0,0 +1,59 @@
+# Peak memory of handing a page and its region crops to doctr: PNG round trip vs NumPy views
+#
+# tracemalloc sees the Python bytes buffers and every NumPy array doctr or the
+# pipeline allocates, which is where the round trip's extra copies live.
+# Usage: python scripts/benchmark_crop_memory.py [image path]
+
+import io
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+from PIL import Image
+from doctr.io import DocumentFile
+
+root_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(root_dir / "backend"))
+from ocr_pipeline import _crop_view, _detect_regions, registry
+
+default_page = root_dir / "dataset" / "testing_data" / "images" / "82092117.png"
+
+### HANDOFF MODES
+
+def png_round_trip(image, regions):
+     # what extract_document_text used to do: encode every crop, doctr decodes it again
+     encoded = []
+     for region in regions:
+          buf = io.BytesIO()
+          image.crop(region["bbox"]).convert("RGB").save(buf, format="PNG")
+          encoded.append(buf.getvalue())
+     buf = io.BytesIO()
+     image.save(buf, format="PNG")
+     encoded.append(buf.getvalue())
+     return DocumentFile.from_images(encoded)
+
+def numpy_views(image, regions):
+     page = np.asarray(image)
+     return [_crop_view(page, region["bbox"]) for region in regions] + [page]
+
+modes = {"png round trip": png_round_trip, "numpy views": numpy_views}
+
+### RUN
+
+page_path = sys.argv[1] if len(sys.argv) > 1 else str(default_page)
+with Image.open(page_path) as image:
+     image = image.convert("RGB")
+     regions = _detect_regions(image, registry.get_cnn_model()).to_regions()
+
+     print(f"Page: {page_path} ({image.width}x{image.height}, {len(regions)} regions + full page)")
+     print(f"{'mode':>15} {'time ms':>9} {'peak MB':>9}")
+     for name, handoff in modes.items():
+          tracemalloc.start()
+          start = time.perf_counter()
+          pages = handoff(image, regions)
+          elapsed = time.perf_counter() - start
+          _, peak = tracemalloc.get_traced_memory()
+          tracemalloc.stop()
+          del pages
+          print(f"{name:>15} {elapsed * 1000:>9.1f} {peak / 2**20:>9.2f}")
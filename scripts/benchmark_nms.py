@@ -0,0 +1,86 @@
+# NMS micro-benchmark: tensor NMS in ocr_pipeline vs the old list-based version
+
+import sys
+import time
+from pathlib import Path
+import torch
+
+root_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(root_dir / "backend"))
+from ocr_pipeline import DetectionBatch, _apply_nms
+
+sizes = [100, 250, 500, 1000, 2500, 5000]
+repeats = 5
+page_w, page_h = 750, 1000
+
+### OLD IMPLEMENTATION (list of dicts, pop(0) + scalar IoU)
+
+def legacy_iou(box1, box2):
+     x1_1, y1_1, x2_1, y2_1 = box1
+     x1_2, y1_2, x2_2, y2_2 = box2
+     xi1 = max(x1_1, x1_2)
+     yi1 = max(y1_1, y1_2)
+     xi2 = min(x2_1, x2_2)
+     yi2 = min(y2_1, y2_2)
+     if xi2 <= xi1 or yi2 <= yi1:
+          return 0.0
+     inter_area = (xi2 - xi1) * (yi2 - yi1)
+     union_area = (x2_1 - x1_1) * (y2_1 - y1_1) + (x2_2 - x1_2) * (y2_2 - y1_2) - inter_area
+     if union_area == 0:
+          return 0.0
+     return inter_area / union_area
+
+def legacy_nms(detections, iou_threshold=0.5):
+     sorted_detections = sorted(detections, key=lambda d: d["score"], reverse=True)
+     keep = []
+     while sorted_detections:
+          current = sorted_detections.pop(0)
+          keep.append(current)
+          sorted_detections = [
+               det for det in sorted_detections
+               if legacy_iou(current["bbox"], det["bbox"]) < iou_threshold
+          ]
+     return keep
+
+### SYNTHETIC DETECTIONS
+
+# Boxes jitter around a handful of text lines, like a noisy scan where many
+# neighbouring grid cells fire on the same field
+def synthetic_batch(n, generator):
+     lines = max(n // 20, 1)
+     centers = torch.rand(lines, 2, generator=generator) * torch.tensor([page_w, page_h])
+     sizes_wh = torch.rand(lines, 2, generator=generator) * torch.tensor([200.0, 30.0]) + torch.tensor([20.0, 10.0])
+     pick = torch.randint(0, lines, (n,), generator=generator)
+     jitter = (torch.rand(n, 2, generator=generator) - 0.5) * sizes_wh[pick] * 0.6
+     cxy = centers[pick] + jitter
+     half = sizes_wh[pick] / 2
+     boxes = torch.cat([cxy - half, cxy + half], dim=1).floor()
+     boxes[:, 0::2] = boxes[:, 0::2].clamp(0, page_w)
+     boxes[:, 1::2] = boxes[:, 1::2].clamp(0, page_h)
+     scores = torch.rand(n, generator=generator) * 0.3 + 0.7
+     labels = torch.randint(0, 4, (n,), generator=generator)
+     return DetectionBatch(boxes, scores, labels)
+
+def best_of(fn):
+     best = float("inf")
+     for _ in range(repeats):
+          start = time.perf_counter()
+          out = fn()
+          best = min(best, time.perf_counter() - start)
+     return best, out
+
+### RUN
+
+generator = torch.Generator().manual_seed(0)
+print(f"{'boxes':>6} {'legacy ms':>10} {'tensor ms':>10} {'class-aware ms':>15} {'speedup':>8} {'kept':>11}")
+for n in sizes:
+     batch = synthetic_batch(n, generator)
+     regions = batch.to_regions()
+
+     legacy_time, legacy_kept = best_of(lambda: legacy_nms(regions))
+     tensor_time, tensor_kept = best_of(lambda: _apply_nms(batch))
+     aware_time, _ = best_of(lambda: _apply_nms(batch, class_aware=True))
+
+     kept = f"{len(legacy_kept)}/{len(tensor_kept)}"
+     print(f"{n:>6} {legacy_time * 1000:>10.2f} {tensor_time * 1000:>10.2f} {aware_time * 1000:>15.2f} "
+           f"{legacy_time / tensor_time:>7.1f}x {kept:>11}")
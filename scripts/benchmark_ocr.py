@@ -0,0 +1,146 @@
+# End-to-end OCR benchmark over the bundled FUNSD-style testing set
+#
+# Runs extract_document_text on every page and reports throughput, latency
+# percentiles, peak memory, detector precision/recall at IoU 0.5 against the
+# annotated fields and the character error rate of the extracted text.
+# The JSON report records the git commit and OCR settings so runs can be
+# compared across commits with --compare.
+# Usage: python scripts/benchmark_ocr.py [--limit N] [--output report.json] [--compare old.json]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from PIL import Image
+
+root_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(root_dir / "backend"))
+import ocr_pipeline
+from ocr_eval import (
+     detection_scores, edit_distance, load_annotation, normalize_text, precision_recall, reading_order_text, reference_text
+)
+
+parser = argparse.ArgumentParser(description="End-to-end OCR benchmark over the bundled FUNSD-style testing set")
+parser.add_argument("--images", type=Path, default=root_dir / "dataset" / "testing_data" / "images")
+parser.add_argument("--annotations", type=Path, default=root_dir / "dataset" / "testing_data" / "annotations")
+parser.add_argument("--limit", type=int, default=None, help="only the first N pages")
+parser.add_argument("--output", type=Path, default=None, help="report path (default benchmarks/ocr_<commit>.json)")
+parser.add_argument("--compare", type=Path, default=None, help="earlier report to print deltas against")
+args = parser.parse_args()
+
+### HELPERS
+
+def git_commit():
+     try:
+          commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=root_dir, text=True).strip()
+          dirty = subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=root_dir) != 0
+     except (OSError, subprocess.CalledProcessError):
+          return "unknown", False
+     return commit, dirty
+
+def percentile(values, q):
+     ordered = sorted(values)
+     return ordered[min(int(round(q / 100 * (len(ordered) - 1))), len(ordered) - 1)]
+
+### RUN
+
+paths = sorted(p for p in args.images.iterdir() if p.suffix.lower() in {".png", ".jpg", ".jpeg", ".tif", ".tiff"})
+if args.limit:
+     paths = paths[:args.limit]
+
+print("Warming up models...")
+ocr_pipeline.warmup_models()
+model = ocr_pipeline.registry.get_cnn_model()
+
+latencies = []
+stage_totals = {}
+detection = {"matched": 0, "label_matched": 0, "predicted": 0, "reference": 0}
+edits = reference_chars = 0
+modes = {}
+errors = 0
+
+for index, path in enumerate(paths, 1):
+     page_start = time.perf_counter()
+     result = ocr_pipeline.extract_document_text(str(path))
+     latencies.append(time.perf_counter() - page_start)
+
+     metrics = result.get("metrics", {})
+     for stage, seconds in metrics.get("stages", {}).items():
+          stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+     for mode in metrics.get("page_modes", []):
+          modes[mode] = modes.get(mode, 0) + 1
+     errors += bool(result.get("error"))
+
+     annotation_path = args.annotations / f"{path.stem}.json"
+     if annotation_path.exists():
+          fields = load_annotation(annotation_path)
+          # the detector on its own, before any full-page fallback replaces its boxes (not timed)
+          with Image.open(path) as image:
+               regions = ocr_pipeline._detect_regions(image.convert("RGB"), model).to_regions()
+          for key, value in detection_scores(regions, fields).items():
+               detection[key] += value
+          # the pipeline joins regions in detection (score) order; compare both sides in reading order
+          reference = normalize_text(reference_text(fields))
+          edits += edit_distance(normalize_text(reading_order_text(result.get("regions", []))), reference)
+          reference_chars += len(reference)
+     print(f"[{index}/{len(paths)}] {path.name} {latencies[-1]:.2f}s")
+# throughput covers extract_document_text only, not the untimed detector pass and scoring above
+elapsed = sum(latencies)
+
+### REPORT
+
+commit, dirty = git_commit()
+report = {
+     "commit": commit,
+     "dirty": dirty,
+     "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+     "fingerprint": ocr_pipeline.ocr_fingerprint(),
+     "settings": {key: value for key, value in sorted(os.environ.items()) if key.startswith("OCR_")},
+     "pages": len(paths),
+     "pages_per_second": len(paths) / elapsed if elapsed else 0.0,
+     "latency_seconds": {
+          "mean": statistics.mean(latencies),
+          "p50": percentile(latencies, 50),
+          "p95": percentile(latencies, 95),
+          "p99": percentile(latencies, 99),
+     },
+     "stage_seconds_mean": {stage: total / len(paths) for stage, total in sorted(stage_totals.items())},
+     "peak_rss_bytes": ocr_pipeline._peak_rss_bytes(),
+     "detection_iou_0_5": {**precision_recall(detection), **detection},
+     "cer": edits / reference_chars if reference_chars else None,
+     "page_modes": modes,
+     "errors": errors,
+}
+
+output = args.output or root_dir / "benchmarks" / f"ocr_{commit[:10]}{'-dirty' if dirty else ''}.json"
+output.parent.mkdir(parents=True, exist_ok=True)
+with open(output, "w", encoding="utf-8") as f:
+     json.dump(report, f, indent=2)
+
+latency = report["latency_seconds"]
+det = report["detection_iou_0_5"]
+print(f"\n{report['pages']} pages, {report['pages_per_second']:.3f} pages/s")
+print(f"latency p50 {latency['p50']:.2f}s  p95 {latency['p95']:.2f}s  p99 {latency['p99']:.2f}s")
+print(f"peak RSS {(report['peak_rss_bytes'] or 0) / 2**20:.0f} MB")
+print(f"detection P {det['precision']:.3f}  R {det['recall']:.3f}  F1 {det['f1']:.3f}")
+print(f"CER {report['cer']:.3f}" if report["cer"] is not None else "CER n/a (no annotations)")
+print(f"report written to {output}")
+
+if args.compare:
+     with open(args.compare, "r", encoding="utf-8") as f:
+          old = json.load(f)
+     rows = [
+          ("pages/s", old["pages_per_second"], report["pages_per_second"]),
+          ("p50 s", old["latency_seconds"]["p50"], latency["p50"]),
+          ("p95 s", old["latency_seconds"]["p95"], latency["p95"]),
+          ("peak RSS MB", (old["peak_rss_bytes"] or 0) / 2**20, (report["peak_rss_bytes"] or 0) / 2**20),
+          ("det F1", old["detection_iou_0_5"]["f1"], det["f1"]),
+          ("CER", old["cer"] or 0.0, report["cer"] or 0.0),
+     ]
+     print(f"\nvs {old['commit'][:10]}:")
+     for name, before, after in rows:
+          print(f"{name:>12} {before:>10.3f} -> {after:>10.3f} ({after - before:+.3f})")
@@ -0,0 +1,86 @@
+# Detector backend parity + latency: eager PyTorch vs TorchScript vs ONNX Runtime
+#
+# Every test image is prepared exactly like _detect_regions does, run through
+# each backend, and the raw output grids are compared against eager within
+# TOLERANCE. Decoded boxes and labels are compared too, since a cell sitting right on
+# obj_threshold can flip even when the grids agree. Exits non-zero on a
+# parity failure.
+# Usage: python scripts/detector_parity.py [image dir]
+
+import statistics
+import sys
+import time
+from pathlib import Path
+import torch
+from PIL import Image
+from torchvision.transforms import ToTensor
+
+root_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(root_dir / "backend"))
+from ocr_pipeline import ConvolutionalNN, _apply_nms, _decode_grid, _load_cnn_model, _prepare_image, max_regions, model_state_path
+
+TOLERANCE = 1e-4
+backends = ["eager", "torchscript", "onnx"]
+image_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else root_dir / "dataset" / "testing_data" / "images"
+
+### LOAD
+
+models = {}
+for backend in backends:
+     model = _load_cnn_model(model_state_path, backend=backend)
+     if model is None:
+          sys.exit(f"Model weights not found at {model_state_path}")
+     if backend != "eager" and isinstance(model, ConvolutionalNN):
+          print(f"{backend}: not available, fell back to eager (see log), skipping")
+          continue
+     models[backend] = model
+
+def run(model, tensor):
+     with torch.no_grad():
+          return [out[0].cpu() for out in model(tensor)]
+
+def regions(outputs, img, scale):
+     # boxes and labels only: scores differ in the last float bits between runtimes
+     detections = _decode_grid(*outputs, img.size, scale)
+     return [(r["bbox"], r["label"]) for r in _apply_nms(detections).select(slice(0, max_regions)).to_regions()]
+
+### RUN
+
+paths = sorted(p for p in image_dir.iterdir() if p.suffix.lower() in {".png", ".jpg", ".jpeg", ".tif", ".tiff"})
+latencies = {backend: [] for backend in models}
+max_diff = {backend: 0.0 for backend in models}
+region_mismatches = {backend: 0 for backend in models}
+
+for path in paths:
+     with Image.open(path) as image:
+          img, scale_x, scale_y = _prepare_image(image)
+     tensor = ToTensor()(img).unsqueeze(0)
+     reference = None
+     for backend, model in models.items():
+          run(model, tensor)  # warm the shape
+          start = time.perf_counter()
+          outputs = run(model, tensor)
+          latencies[backend].append(time.perf_counter() - start)
+          if reference is None:
+               reference = outputs
+               reference_regions = regions(outputs, img, (scale_x, scale_y))
+               continue
+          diff = max((out - ref).abs().max().item() for out, ref in zip(outputs, reference))
+          max_diff[backend] = max(max_diff[backend], diff)
+          if regions(outputs, img, (scale_x, scale_y)) != reference_regions:
+               region_mismatches[backend] += 1
+
+### REPORT
+
+print(f"{len(paths)} images from {image_dir}")
+print(f"{'backend':>12} {'mean ms':>9} {'p50 ms':>8} {'p95 ms':>8} {'max |diff|':>11} {'region mismatches':>18}")
+failed = False
+for backend in models:
+     times = sorted(latencies[backend])
+     p95 = times[min(int(len(times) * 0.95), len(times) - 1)]
+     print(f"{backend:>12} {statistics.mean(times) * 1000:>9.1f} {statistics.median(times) * 1000:>8.1f} "
+           f"{p95 * 1000:>8.1f} {max_diff[backend]:>11.2e} {region_mismatches[backend]:>18}")
+     failed |= max_diff[backend] > TOLERANCE
+if failed:
+     sys.exit(f"parity FAILED: outputs differ from eager by more than {TOLERANCE}")
+print("parity OK")
@@ -0,0 +1,97 @@
+# Accuracy drop and speed of the optimized detector builds against the fp32 model
+#
+# fp32 is eager PyTorch; fused folds BatchNorm into the convs and runs
+# channels_last; int8 is the static-quantized build calibrated on
+# dataset/training_data (OCR_DETECT_CALIBRATION_IMAGES pages). For each
+# build the testing set is scored twice: against the fp32 detections
+# (agreement) and against the annotated fields (accuracy), both at IoU 0.5.
+# Usage: python scripts/detector_quantization_report.py [image dir] [annotation dir]
+
+import statistics
+import sys
+import time
+from pathlib import Path
+import torch
+from PIL import Image
+from torchvision.transforms import ToTensor
+
+root_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(root_dir / "backend"))
+import ocr_pipeline
+from ocr_eval import detection_scores, load_annotation, precision_recall
+
+image_dir = Path(sys.argv[1]) if len(sys.argv) > 1 else root_dir / "dataset" / "testing_data" / "images"
+annotation_dir = Path(sys.argv[2]) if len(sys.argv) > 2 else root_dir / "dataset" / "testing_data" / "annotations"
+builds = ["eager", "fused", "int8"]
+repeats = 3
+
+### LOAD
+
+models = {}
+for build in builds:
+     start = time.perf_counter()
+     if build == "int8":
+          # calibrated here rather than loaded: the backend refuses int8 builds that fail their parity check
+          calibration = sorted(ocr_pipeline.calibration_dir.glob("*.png"))[:ocr_pipeline.calibration_images]
+          model = ocr_pipeline._quantize_detector(models["eager"], calibration)
+     else:
+          model = ocr_pipeline._load_cnn_model(ocr_pipeline.model_state_path, backend=build)
+     if model is None:
+          sys.exit(f"Model weights not found at {ocr_pipeline.model_state_path}")
+     if build != "eager" and isinstance(model, ocr_pipeline.ConvolutionalNN):
+          print(f"{build}: not available, fell back to eager (see log), skipping")
+          continue
+     models[build] = model
+     print(f"loaded {build} in {time.perf_counter() - start:.1f}s")
+
+def empty_counts():
+     return {"matched": 0, "label_matched": 0, "predicted": 0, "reference": 0}
+
+def add(total, counts):
+     for key in total:
+          total[key] += counts[key]
+
+### RUN
+
+paths = sorted(p for p in image_dir.iterdir() if p.suffix.lower() == ".png")
+latencies = {build: [] for build in models}
+agreement = {build: empty_counts() for build in models}
+accuracy = {build: empty_counts() for build in models}
+
+for path in paths:
+     with Image.open(path) as image:
+          image = image.convert("RGB")
+     annotation = load_annotation(annotation_dir / f"{path.stem}.json")
+     reference = None
+     for build, model in models.items():
+          img, _, _ = ocr_pipeline._prepare_image(image)
+          tensor = ToTensor()(img).unsqueeze(0)
+          with torch.no_grad():
+               model(tensor)
+               best = float("inf")
+               for _ in range(repeats):
+                    start = time.perf_counter()
+                    model(tensor)
+                    best = min(best, time.perf_counter() - start)
+          latencies[build].append(best)
+
+          regions = ocr_pipeline._detect_regions(image, model).to_regions()
+          if reference is None:
+               reference = regions
+          add(agreement[build], detection_scores(regions, reference))
+          add(accuracy[build], detection_scores(regions, annotation))
+
+### REPORT
+
+print(f"\n{len(paths)} pages from {image_dir}, best of {repeats} forward passes each")
+print(f"{'build':>6} {'p50 ms':>8} {'speedup':>8} {'fp32 P':>7} {'fp32 R':>7} {'fp32 lbl':>9} "
+      f"{'gt P':>6} {'gt R':>6} {'gt F1':>6} {'F1 drop':>8}")
+base_latency = statistics.median(latencies["eager"])
+base_f1 = precision_recall(accuracy["eager"])["f1"]
+for build in models:
+     p50 = statistics.median(latencies[build])
+     agree = precision_recall(agreement[build])
+     acc = precision_recall(accuracy[build])
+     print(f"{build:>6} {p50 * 1000:>8.1f} {base_latency / p50:>7.2f}x {agree['precision']:>7.3f} {agree['recall']:>7.3f} "
+           f"{agree['label_accuracy']:>9.3f} {acc['precision']:>6.3f} {acc['recall']:>6.3f} {acc['f1']:>6.3f} "
+           f"{base_f1 - acc['f1']:>+8.3f}")
@@ -0,0 +1,27 @@
+# Export the detector checkpoint to TorchScript, ONNX and int8 for OCR_DETECT_BACKEND
+#
+# ocr_pipeline never exports: a missing artifact, or one older than the
+# checkpoint, makes it serve the eager model instead. Run this at deploy
+# time and after every new checkpoint. The int8 build is calibrated here
+# and checked against fp32 on the testing pages; the parity report is
+# written next to it, and ocr_pipeline refuses an int8 build whose report
+# is missing or below OCR_INT8_MIN_AGREEMENT.
+# Usage: python scripts/export_detector.py [checkpoint path]
+
+import json
+import sys
+from pathlib import Path
+
+root_dir = Path(__file__).resolve().parents[1]
+sys.path.append(str(root_dir / "backend"))
+from ocr_pipeline import _parity_path, export_detector, int8_min_agreement, model_state_path
+
+state_path = Path(sys.argv[1]) if len(sys.argv) > 1 else model_state_path
+for backend, path in export_detector(state_path).items():
+     print(f"{backend:>12}: {path} ({path.stat().st_size / 2**20:.1f} MB)")
+     if backend == "int8":
+          with open(_parity_path(path), encoding="utf-8") as f:
+               report = json.load(f)
+          served = min(report["precision"], report["recall"]) >= int8_min_agreement
+          print(f"{'':>12}  vs fp32 on {report['pages']} pages: precision {report['precision']:.3f}, "
+                f"recall {report['recall']:.3f} -> {'served' if served else f'refused (needs {int8_min_agreement})'}")